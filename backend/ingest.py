@@ -1,18 +1,24 @@
 """
-Ingesta de fuentes (PDF y DOCX) -> índice FAISS + metadatos JSON.
+Ingesta de fuentes (PDF y DOCX) -> índice FAISS + metadatos columnares (Arrow IPC).
 
-- Extracción robusta:
-  * PDF con pypdf
+- Extracción robusta (en paralelo, un proceso por archivo):
+  * PDF con PyMuPDF (fallback a pypdf)
   * DOCX con python-docx
 - Normalización de texto:
   * Quitar guiones de final de línea
   * Unificar saltos de línea y espacios (incl. no-break spaces)
 - Chunking semántico por tokens (~900) con solape (150)
 - Metadatos por fragmento: título, año, páginas, fuente (filename)
-- Validación: lista de archivos fallidos con causa
+- Índice HNSW float16 (por defecto) o IVF-PQ (nlist ~ 4·sqrt(N); flat
+  float16 para corpus pequeños), según INDEX_TYPE. HNSW guarda además los
+  enlaces del grafo y se carga entero en RAM (sin mmap ni GPU); IVF-PQ es la
+  opción de menor memoria para corpus grandes
+- Validación: lista de archivos fallidos con causa y etapa; los PDFs
+  escaneados (sin texto) se detectan al inicio y quedan pendientes de OCR
 - Salida:
   * storage/index.faiss
-  * storage/docs.json
+  * storage/docs.arrow (Arrow IPC sin comprimir, mapeable en memoria;
+    fila i <-> vector i del índice)
 
 Uso:
   python backend/ingest.py
@@ -22,20 +28,29 @@ from __future__ import annotations
 
 import os
 import re
-import json
+import asyncio
 import glob
 import math
-import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dataclasses import dataclass
-from typing import List, Dict, Any, Optional, Tuple
+from typing import Callable, List, Dict, Any, Optional, Tuple
 
 import numpy as np
 import faiss
+import pyarrow as pa
 from tqdm import tqdm
 from pypdf import PdfReader
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
 from docx import Document
 import tiktoken
-from openai import OpenAI
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+from openai import AsyncOpenAI
 
 # Ajusta rutas base
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -43,7 +58,20 @@ DATA_DIR = os.path.join(ROOT_DIR, "data")
 STORAGE_DIR = os.path.join(ROOT_DIR, "storage")
 
 FAISS_PATH = os.path.join(STORAGE_DIR, "index.faiss")
-DOCS_JSON = os.path.join(STORAGE_DIR, "docs.json")
+DOCS_ARROW = os.path.join(STORAGE_DIR, "docs.arrow")
+
+# Metadatos por fragmento (columnar); las cadenas repetidas se codifican como diccionario
+_DICT_STR = pa.dictionary(pa.int32(), pa.string())
+RECORD_SCHEMA = pa.schema([
+    ("text", pa.string()),
+    ("filename", _DICT_STR),
+    ("source", _DICT_STR),
+    ("title", _DICT_STR),
+    ("year", pa.int32()),
+    ("page", pa.int32()),
+    ("pages_total", pa.int32()),
+    ("filetype", _DICT_STR),
+])
 
 # Tokenización (modelo de embeddings)
 ENC = tiktoken.get_encoding("cl100k_base")
@@ -51,9 +79,27 @@ ENC = tiktoken.get_encoding("cl100k_base")
 # Parámetros de chunking
 CHUNK_TOKENS = 900
 OVERLAP_TOKENS = 150
+# Hilos del tokenizador (Rust) en las llamadas batch
+ENCODE_THREADS = os.cpu_count() or 8
+
+# Tipo de índice: "hnsw" (grafo, baja latencia por consulta; por defecto)
+# o "ivfpq" (códigos comprimidos, para corpus muy grandes)
+INDEX_TYPE = "hnsw"
+
+# Parámetros del índice HNSW
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+
+# Parámetros del índice IVF-PQ
+PQ_M = 32          # subcuantizadores (debe dividir la dimensión del embedding)
+PQ_NBITS = 8       # bits por código PQ
+IVF_NLIST_FACTOR = 4
+IVF_MIN_TRAIN_PER_LIST = 39  # mínimo recomendado por FAISS para entrenar k-means
 
 # Modelo de embeddings
 DEFAULT_EMBED_MODEL = "text-embedding-3-small"
+# Peticiones de embeddings simultáneas durante la ingesta
+EMBED_CONCURRENCY = 16
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 
@@ -61,19 +107,23 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 # Normalización de texto
 # ---------------------------
 
-NBSP_RE = re.compile(r"\u00A0")
+# Espacios especiales y separadores de control (\x1c-\x1f, U+180E) -> espacio;
+# CR suelto -> salto de línea (CRLF se trata antes)
+_SPACE_TRANS = str.maketrans({
+    "\u00A0": " ", "\u2009": " ", "\u2002": " ", "\u2003": " ", "\r": "\n",
+    "\x1c": " ", "\x1d": " ", "\x1e": " ", "\x1f": " ", "\u180e": " ",
+})
 MULTISPACE_RE = re.compile(r"[ \t]{2,}")
-LINE_HYPHEN_RE = re.compile(r"(\w)-\n(\w)")
-CRLF_RE = re.compile(r"\r\n?")
+# Lookahead: la letra siguiente no se consume, así se unen también líneas
+# cortadas consecutivas ("a-\nb-\nc" -> "abc") en una sola pasada
+LINE_HYPHEN_RE = re.compile(r"(\w)-\n(?=\w)")
 MULTI_NL_RE = re.compile(r"\n{3,}")
 
 def clean_text(s: str) -> str:
     if not s:
         return ""
-    s = CRLF_RE.sub("\n", s)
-    s = LINE_HYPHEN_RE.sub(r"\1\2", s)
-    s = NBSP_RE.sub(" ", s)
-    s = s.replace("\u2009", " ").replace("\u2002", " ").replace("\u2003", " ")
+    s = s.replace("\r\n", "\n").translate(_SPACE_TRANS)
+    s = LINE_HYPHEN_RE.sub(r"\1", s)
     s = MULTISPACE_RE.sub(" ", s)
     s = MULTI_NL_RE.sub("\n\n", s)
     return s.strip()
@@ -105,28 +155,99 @@ def guess_title_year_from_filename(filename: str) -> Tuple[Optional[str], Option
         title = re.sub(r"\s+", " ", title).strip().title()
     return title or None, year
 
-def extract_pdf(path: str) -> Tuple[str, DocMeta, List[Tuple[int, str]]]:
+# Detección de PDFs escaneados (sin capa de texto). Sondeo barato de las
+# primeras páginas; si no hay texto, se confirma con una muestra repartida
+# por el documento y con la presencia de imágenes antes de descartarlo.
+OCR_PROBE_PAGES = 3
+OCR_SAMPLE_PAGES = 8
+OCR_MIN_CHARS = 20
+
+class NeedsOCRError(Exception):
+    """El PDF no tiene texto extraíble; debe pasar por OCR antes de indexarse."""
+
+def _low_text(texts: List[str]) -> bool:
+    return sum(len(t.strip()) for t in texts) < OCR_MIN_CHARS
+
+def _sample_pages(page_count: int) -> List[int]:
+    idx = set(range(min(OCR_PROBE_PAGES, page_count)))
+    if page_count > 0:
+        idx.update(np.linspace(0, page_count - 1, min(OCR_SAMPLE_PAGES, page_count)).astype(int).tolist())
+    return sorted(idx)
+
+def _check_text_layer(page_count: int, text_of: Callable[[int], str], has_images: Callable[[int], bool]) -> None:
+    """Lanza NeedsOCRError solo si la muestra no tiene texto pero sí imágenes."""
+    if not _low_text([text_of(i) for i in range(min(OCR_PROBE_PAGES, page_count))]):
+        return
+    sample = _sample_pages(page_count)
+    if _low_text([text_of(i) for i in sample]) and any(has_images(i) for i in sample):
+        raise NeedsOCRError(f"sin texto en {len(sample)} páginas muestreadas con imágenes (¿escaneado?)")
+
+def _read_pdf_fitz(path: str) -> Tuple[List[Tuple[int, str]], Optional[str], Optional[str]]:
+    doc = fitz.open(path)
+    try:
+        texts: Dict[int, str] = {}
+
+        def text_of(i: int) -> str:
+            if i not in texts:
+                texts[i] = doc[i].get_text("text") or ""
+            return texts[i]
+
+        _check_text_layer(doc.page_count, text_of, lambda i: bool(doc[i].get_images()))
+        pages_text = [(i + 1, text_of(i)) for i in range(doc.page_count)]
+        meta = doc.metadata or {}
+        return pages_text, meta.get("title") or None, meta.get("creationDate") or None
+    finally:
+        doc.close()
+
+def _read_pdf_pypdf(path: str) -> Tuple[List[Tuple[int, str]], Optional[str], Optional[str]]:
     reader = PdfReader(path)
-    pages_text: List[Tuple[int, str]] = []
-    for i, page in enumerate(reader.pages, start=1):
+    texts: Dict[int, str] = {}
+
+    def text_of(i: int) -> str:
+        if i not in texts:
+            try:
+                texts[i] = reader.pages[i].extract_text() or ""
+            except Exception:
+                texts[i] = ""
+        return texts[i]
+
+    def has_images(i: int) -> bool:
         try:
-            t = page.extract_text() or ""
+            return len(reader.pages[i].images) > 0
         except Exception:
-            t = ""
-        pages_text.append((i, t))
+            return False
+
+    page_count = len(reader.pages)
+    _check_text_layer(page_count, text_of, has_images)
+    pages_text = [(i + 1, text_of(i)) for i in range(page_count)]
 
     raw_title = None
-    year = None
+    raw_date = None
     try:
         meta = reader.metadata or {}
         raw_title = meta.get("/Title") if isinstance(meta, dict) else None
         raw_date = meta.get("/CreationDate") if isinstance(meta, dict) else None
-        if raw_date:
-            m = re.search(r"(\d{4})", str(raw_date))
-            if m:
-                year = int(m.group(1))
     except Exception:
         pass
+    return pages_text, raw_title, raw_date
+
+def extract_pdf(path: str) -> Tuple[str, DocMeta, List[Tuple[int, str]]]:
+    pages_text = None
+    if fitz is not None:
+        try:
+            pages_text, raw_title, raw_date = _read_pdf_fitz(path)
+        except NeedsOCRError:
+            raise
+        except Exception:
+            pages_text = None
+    if pages_text is None:
+        pages_text, raw_title, raw_date = _read_pdf_pypdf(path)
+
+    year = None
+    if raw_date:
+        m = re.search(r"(\d{4})", str(raw_date))
+        if m:
+            year = int(m.group(1))
 
     fallback_title, fallback_year = guess_title_year_from_filename(path)
     title = raw_title or fallback_title
@@ -158,71 +279,228 @@ def extract_docx(path: str) -> Tuple[str, DocMeta, List[Tuple[int, str]]]:
     )
     return "docx", meta_doc, [(1, full)]
 
+def _extract_one(path: str) -> Optional[Tuple[DocMeta, List[Tuple[int, str]]]]:
+    """Worker de extracción (nivel de módulo para poder serializarse entre procesos)."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        _, meta_doc, pages = extract_pdf(path)
+    elif ext == ".docx":
+        _, meta_doc, pages = extract_docx(path)
+    else:
+        return None
+    return meta_doc, pages
+
 # ---------------------------
 # Chunking semántico
 # ---------------------------
 
 SENT_SPLIT_RE = re.compile(r"(?<=[\.\?\!…])\s+(?=[A-ZÁÉÍÓÚÜÑ0-9])")
 
+# Misma frontera para Hyperscan, que no admite lookarounds: se busca
+# "puntuación + espacios + mayúscula" y el corte se deduce de los offsets.
+SENT_BOUNDARY_PATTERN = r"[\.\?\!…]\s+[A-ZÁÉÍÓÚÜÑ0-9]"
+
+def _compile_sent_db() -> Optional[Any]:
+    if hyperscan is None:
+        return None
+    try:
+        db = hyperscan.Database()
+        db.compile(
+            expressions=[SENT_BOUNDARY_PATTERN.encode("utf-8")],
+            ids=[0],
+            elements=1,
+            flags=[hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP | hyperscan.HS_FLAG_SOM_LEFTMOST],
+        )
+        return db
+    except Exception:
+        return None
+
+SENT_DB = _compile_sent_db()
+
+def _utf8_char_len(lead: int) -> int:
+    if lead < 0x80:
+        return 1
+    if lead >= 0xF0:
+        return 4
+    if lead >= 0xE0:
+        return 3
+    return 2
+
+# Caracteres que `\s` de Python considera espacio y el `\s` UCP de Hyperscan no
+# (clean_text ya los normaliza; esto cubre llamadas con texto sin limpiar)
+_HS_UNSUPPORTED_RE = re.compile(r"[\x1c-\x1f\u180e]")
+
+def split_sentences(text: str) -> List[str]:
+    """Equivalente a SENT_SPLIT_RE.split(text); usa Hyperscan si está disponible."""
+    if SENT_DB is None or _HS_UNSUPPORTED_RE.search(text):
+        return SENT_SPLIT_RE.split(text)
+    try:
+        data = text.encode("utf-8")
+    except UnicodeEncodeError:  # surrogates sueltos (p. ej. ToUnicode roto en pypdf)
+        return SENT_SPLIT_RE.split(text)
+    matches: List[Tuple[int, int]] = []
+    SENT_DB.scan(data, match_event_handler=lambda _id, start, end, _flags, _ctx: matches.append((start, end)))
+    parts: List[str] = []
+    pos = 0
+    for start, end in matches:
+        left = start + _utf8_char_len(data[start])   # tras la puntuación
+        right = end - 1                               # inicio de la mayúscula
+        while data[right] & 0xC0 == 0x80:
+            right -= 1
+        if left < pos:
+            continue
+        parts.append(data[pos:left].decode("utf-8"))
+        pos = right
+    parts.append(data[pos:].decode("utf-8"))
+    return parts
+
 def token_len(text: str) -> int:
     return len(ENC.encode(text))
 
-def sentences_from_text(text: str) -> List[str]:
-    text = clean_text(text)
-    parts = SENT_SPLIT_RE.split(text)
-    out: List[str] = []
-    for part in parts:
-        if token_len(part) > CHUNK_TOKENS * 1.5:
-            out.extend([p for p in part.split("\n\n") if p.strip()])
+def _split_parts(text: str) -> List[str]:
+    return split_sentences(clean_text(text))
+
+def _sentences_with_ids(parts: List[str], parts_ids: List[List[int]]) -> Tuple[List[str], List[List[int]]]:
+    sents: List[str] = []
+    ids: List[List[int]] = []
+    for part, part_ids in zip(parts, parts_ids):
+        if len(part_ids) > CHUNK_TOKENS * 1.5:
+            paras = [p for p in part.split("\n\n") if p.strip()]
+            sents.extend(paras)
+            ids.extend(ENC.encode_ordinary_batch(paras, num_threads=ENCODE_THREADS))
         else:
             if part.strip():
-                out.append(part)
-    return out
+                sents.append(part)
+                ids.append(part_ids)
+    return sents, ids
 
-def chunk_by_tokens(text: str, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = OVERLAP_TOKENS) -> List[str]:
-    sents = sentences_from_text(text)
-    sent_tokens = [token_len(s) for s in sents]
+def _encode_sentences(text: str) -> Tuple[List[str], List[List[int]]]:
+    """Divide en frases y las tokeniza una sola vez (API batch de tiktoken)."""
+    parts = _split_parts(text)
+    return _sentences_with_ids(parts, ENC.encode_ordinary_batch(parts, num_threads=ENCODE_THREADS))
+
+def sentences_from_text(text: str) -> List[str]:
+    return _encode_sentences(text)[0]
+
+def _pack_chunks(sents: List[str], sent_ids: List[List[int]], chunk_tokens: int, overlap_tokens: int) -> List[str]:
+    # Empaquetado voraz sobre la suma acumulada de tokens: el fin de cada
+    # fragmento y el inicio del siguiente (solape) salen de searchsorted.
+    n = len(sents)
+    csum = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in sent_ids], out=csum[1:])
     chunks: List[str] = []
     i = 0
-    n = len(sents)
     while i < n:
-        cur_tokens = 0
-        j = i
-        while j < n and (cur_tokens + sent_tokens[j]) <= chunk_tokens:
-            cur_tokens += sent_tokens[j]
-            j += 1
+        j = int(np.searchsorted(csum, csum[i] + chunk_tokens, side="right")) - 1
         if j == i:
-            toks = ENC.encode(sents[j])
-            slice_text = ENC.decode(toks[:chunk_tokens])
-            chunks.append(slice_text.strip())
+            # Frase mayor que el fragmento: se trunca por tokens
+            chunks.append(ENC.decode(sent_ids[i][:chunk_tokens]).strip())
             i += 1
-        else:
-            chunk_text = " ".join(sents[i:j]).strip()
-            if chunk_text:
-                chunks.append(chunk_text)
-            if j >= n: break
-            back_toks = 0
-            k = j - 1
-            while k >= i and back_toks < overlap_tokens:
-                back_toks += sent_tokens[k]
-                k -= 1
-            i = max(k + 1, i + 1)
+            continue
+        chunk_text = " ".join(sents[i:j]).strip()
+        if chunk_text:
+            chunks.append(chunk_text)
+        if j >= n: break
+        start = int(np.searchsorted(csum, csum[j] - overlap_tokens, side="right")) - 1
+        i = max(start, i + 1)
     return [c for c in chunks if c.strip()]
 
+def chunk_by_tokens(text: str, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = OVERLAP_TOKENS) -> List[str]:
+    sents, sent_ids = _encode_sentences(text)
+    return _pack_chunks(sents, sent_ids, chunk_tokens, overlap_tokens)
+
+def chunk_pages(pages: List[Tuple[int, str]], chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = OVERLAP_TOKENS) -> List[Tuple[int, List[str]]]:
+    """
+    Chunking de todas las páginas de un archivo con una sola llamada batch
+    al tokenizador (aprovecha el pool de hilos de tiktoken). Los fragmentos
+    no cruzan páginas. Devuelve [(página, fragmentos)].
+    """
+    page_parts = [(page_num, _split_parts(raw_text)) for page_num, raw_text in pages]
+    flat = [part for _, parts in page_parts for part in parts]
+    flat_ids = ENC.encode_ordinary_batch(flat, num_threads=ENCODE_THREADS)
+    out: List[Tuple[int, List[str]]] = []
+    pos = 0
+    for page_num, parts in page_parts:
+        parts_ids = flat_ids[pos:pos + len(parts)]
+        pos += len(parts)
+        sents, sent_ids = _sentences_with_ids(parts, parts_ids)
+        chunks = _pack_chunks(sents, sent_ids, chunk_tokens, overlap_tokens)
+        if chunks:
+            out.append((page_num, chunks))
+    return out
+
 # ---------------------------
 # Embeddings y FAISS
 # ---------------------------
 
-def embed_texts(client: OpenAI, texts: List[str], model: str = DEFAULT_EMBED_MODEL, batch_size: int = 100) -> np.ndarray:
-    vecs: List[List[float]] = []
-    for i in tqdm(range(0, len(texts), batch_size), desc="Embeddings"):
-        batch = texts[i:i + batch_size]
-        resp = client.embeddings.create(model=model, input=batch)
-        vecs.extend([d.embedding for d in resp.data])
-    arr = np.array(vecs, dtype="float32")
+async def embed_all(client: AsyncOpenAI, texts: List[str], model: str = DEFAULT_EMBED_MODEL, batch_size: int = 100, concurrency: int = EMBED_CONCURRENCY) -> np.ndarray:
+    # Lotes concurrentes (limitados por semáforo) escritos directamente en un array preasignado
+    sem = asyncio.Semaphore(concurrency)
+    arr: Optional[np.ndarray] = None
+    pbar = tqdm(total=math.ceil(len(texts) / batch_size), desc="Embeddings")
+
+    async def one(i: int) -> None:
+        nonlocal arr
+        async with sem:
+            resp = await client.embeddings.create(model=model, input=texts[i:i + batch_size])
+        if arr is None:
+            arr = np.empty((len(texts), len(resp.data[0].embedding)), dtype="float32")
+        for d in resp.data:
+            arr[i + d.index] = d.embedding
+        pbar.update(1)
+
+    try:
+        await asyncio.gather(*(one(i) for i in range(0, len(texts), batch_size)))
+    finally:
+        pbar.close()
+    if arr is None:
+        return np.empty((0, 0), dtype="float32")
     faiss.normalize_L2(arr)
     return arr
 
+def embed_texts(client: AsyncOpenAI, texts: List[str], model: str = DEFAULT_EMBED_MODEL, batch_size: int = 100) -> np.ndarray:
+    return asyncio.run(embed_all(client, texts, model=model, batch_size=batch_size))
+
+def build_hnsw_index(vectors: np.ndarray) -> faiss.Index:
+    """
+    HNSW sobre producto interno (vectores normalizados => coseno), con los
+    vectores almacenados en float16 (mitad de memoria que float32).
+    """
+    index = faiss.IndexHNSWSQ(vectors.shape[1], faiss.ScalarQuantizer.QT_fp16, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
+def build_ivfpq_index(vectors: np.ndarray) -> faiss.Index:
+    """
+    IVF-PQ sobre producto interno (vectores normalizados => coseno).
+    nlist ~ 4·sqrt(N). Si el corpus es demasiado pequeño para entrenar
+    los centroides y el codebook PQ, se usa búsqueda exacta con los
+    vectores almacenados en float16 (mitad de memoria y de E/S).
+    """
+    n, dim = vectors.shape
+    nlist = max(1, int(math.sqrt(n) * IVF_NLIST_FACTOR))
+    min_train = max(nlist * IVF_MIN_TRAIN_PER_LIST, 1 << PQ_NBITS)
+    if n < min_train or dim % PQ_M != 0:
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        index.add(vectors)
+        return index
+
+    quantizer = faiss.IndexFlatIP(dim)
+    index = faiss.IndexIVFPQ(quantizer, dim, nlist, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
+def build_index(vectors: np.ndarray, index_type: str = INDEX_TYPE) -> faiss.Index:
+    if index_type == "hnsw":
+        return build_hnsw_index(vectors)
+    if index_type == "ivfpq":
+        return build_ivfpq_index(vectors)
+    raise ValueError(f"Tipo de índice desconocido: {index_type}")
+
 # ---------------------------
 # Pipeline principal
 # ---------------------------
@@ -236,63 +514,73 @@ def main() -> None:
     if not files:
         raise SystemExit("⚠️ No se encontraron archivos PDF o DOCX en /data.")
 
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    all_records: List[Dict[str, Any]] = []
+    client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=5)
+    columns: Dict[str, List[Any]] = {c: [] for c in RECORD_SCHEMA.names}
     failed: List[Dict[str, str]] = []
-
-    for path in tqdm(files, desc="Extrayendo documentos"):
-        try:
-            ext = os.path.splitext(path)[1].lower()
-            if ext == ".pdf":
-                _, meta_doc, pages = extract_pdf(path)
-            elif ext == ".docx":
-                _, meta_doc, pages = extract_docx(path)
-            else:
+    needs_ocr: List[str] = []
+
+    extracted: Dict[str, Tuple[DocMeta, List[Tuple[int, str]]]] = {}
+    with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 8)) as ex:
+        futs = {ex.submit(_extract_one, p): p for p in files}
+        for fut in tqdm(as_completed(futs), total=len(futs), desc="Extrayendo documentos"):
+            path = futs[fut]
+            try:
+                result = fut.result()
+            except NeedsOCRError:
+                needs_ocr.append(path)
                 continue
-
-            for page_num, raw_text in pages:
-                cleaned = clean_text(raw_text)
-                if not cleaned:
-                    continue
-                chunks = chunk_by_tokens(cleaned, CHUNK_TOKENS, OVERLAP_TOKENS)
+            except Exception as e:
+                failed.append({"file": path, "stage": "extracción", "error": f"{type(e).__name__}: {e}"})
+                continue
+            if result is not None:
+                extracted[path] = result
+
+    # Chunking en el orden original de archivos (orden estable de vectores)
+    for path in files:
+        if path not in extracted:
+            continue
+        meta_doc, pages = extracted[path]
+        try:
+            for page_num, chunks in chunk_pages(pages, CHUNK_TOKENS, OVERLAP_TOKENS):
                 for ch in chunks:
-                    all_records.append({
-                        "text": ch,
-                        "filename": meta_doc.filename,
-                        "source": meta_doc.source_path,
-                        "title": meta_doc.title,
-                        "year": meta_doc.year,
-                        "page": page_num,
-                        "pages_total": meta_doc.pages_total,
-                        "filetype": meta_doc.filetype,
-                    })
+                    columns["text"].append(ch)
+                    columns["filename"].append(meta_doc.filename)
+                    columns["source"].append(meta_doc.source_path)
+                    columns["title"].append(meta_doc.title)
+                    columns["year"].append(meta_doc.year)
+                    columns["page"].append(page_num)
+                    columns["pages_total"].append(meta_doc.pages_total)
+                    columns["filetype"].append(meta_doc.filetype)
         except Exception as e:
-            failed.append({"file": path, "error": str(e)})
-            traceback.print_exc()
+            failed.append({"file": path, "stage": "chunking", "error": f"{type(e).__name__}: {e}"})
 
-    if not all_records:
+    if not columns["text"]:
         raise SystemExit("❌ No se generaron fragmentos. Revisa los documentos.")
 
-    corpus = [r["text"] for r in all_records]
+    corpus = columns["text"]
     vectors = embed_texts(client, corpus, model=DEFAULT_EMBED_MODEL, batch_size=100)
 
-    dim = vectors.shape[1]
-    index = faiss.IndexFlatIP(dim)
-    index.add(vectors)
+    index = build_index(vectors)
 
     faiss.write_index(index, FAISS_PATH)
-    with open(DOCS_JSON, "w", encoding="utf-8") as f:
-        json.dump(all_records, f, ensure_ascii=False, indent=2)
+    table = pa.table(columns, schema=RECORD_SCHEMA)
+    # Sin compresión: el servidor lo mapea en memoria y solo pagina las filas que lee
+    with pa.OSFile(DOCS_ARROW, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
 
     print(f"✅ Índice guardado en: {FAISS_PATH}")
-    print(f"✅ Metadatos guardados en: {DOCS_JSON}")
-    print(f"📦 Fragmentos: {len(all_records)} | Archivos procesados: {len(files)}")
+    print(f"✅ Metadatos guardados en: {DOCS_ARROW}")
+    print(f"📦 Fragmentos: {table.num_rows} | Archivos procesados: {len(files)}")
     if failed:
         print("⚠️ Archivos con error:")
         for f in failed:
-            print(f"  - {f['file']}: {f['error']}")
+            print(f"  - {f['file']} [{f['stage']}]: {f['error']}")
     else:
         print("✅ Sin fallos de extracción.")
+    if needs_ocr:
+        print("🖨️ PDFs sin capa de texto (pendientes de OCR, no indexados):")
+        for path in sorted(needs_ocr):
+            print(f"  - {path}")
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,21 @@
 import os
+import time
+import hashlib
 import pickle
+import asyncio
 import logging
-from typing import List, Dict, Any
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Set, Tuple
 
 import numpy as np
+from cachetools import TTLCache
 import faiss
+import pyarrow as pa
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from openai import OpenAI
+from pydantic import BaseModel, Field
+from openai import AsyncOpenAI, BadRequestError
 
 from settings import settings
 
@@ -25,62 +32,341 @@ app.add_middleware(
 )
 
 INDEX_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "storage", f"{settings.index_name}.faiss"))
-META_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "storage", "docs.json"))
+META_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "storage", "docs.arrow"))
+# Listas IVF visitadas por consulta (~95% recall con nlist ~ 4·sqrt(N))
+NPROBE = 16
+# Tamaño de la lista de candidatos HNSW por consulta (recall vs. latencia)
+HNSW_EF_SEARCH = 64
+# Memoria temporal reservada por FAISS en GPU
+GPU_TEMP_MEMORY = 512 << 20
+# Caché semántica de respuestas (similitud coseno entre consultas)
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_SIZE = 512
+SEMANTIC_CACHE_TTL = 3600
+SEMANTIC_CACHE_PROBE = 8  # vecinos examinados por consulta
+# Caché LRU exacta consulta -> embedding
+EMBED_CACHE_SIZE = 1024
+# Caché exacta de respuestas por (consulta, k, modelos)
+RESPONSE_CACHE_SIZE = 2048
+RESPONSE_CACHE_TTL = 600
 index = None
-meta: List[Dict[str, Any]] = []
+gpu_res = None
+meta: Optional[pa.Table] = None  # fila i <-> vector i del índice
 
 if os.path.exists(INDEX_PATH) and os.path.exists(META_PATH):
-    index = faiss.read_index(INDEX_PATH)
-    import json
-    with open(META_PATH, "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    logger.info("FAISS index y metadatos cargados (%d fragmentos).", len(meta))
+    # Listas invertidas IVF mapeadas en memoria: solo se leen las que visita cada consulta
+    # (otros tipos de índice se cargan completos)
+    index = faiss.read_index(INDEX_PATH, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = NPROBE
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    # FAISS no tiene versión GPU de HNSW; se queda en CPU
+    if faiss.get_num_gpus() > 0 and not isinstance(index, faiss.IndexHNSW):
+        try:
+            gpu_res = faiss.StandardGpuResources()
+            gpu_res.setTempMemory(GPU_TEMP_MEMORY)
+            index = faiss.index_cpu_to_gpu(gpu_res, 0, index)
+            logger.info("Índice FAISS movido a GPU.")
+        except Exception as e:
+            logger.warning("No se pudo mover el índice a GPU (%s); se usa CPU.", e)
+    # Arrow IPC sin comprimir sobre mmap: la tabla referencia el fichero sin copiarlo
+    meta = pa.ipc.open_file(pa.memory_map(META_PATH, "r")).read_all()
+    logger.info("FAISS index y metadatos cargados (%d fragmentos).", meta.num_rows)
 else:
     logger.warning("No se encontró el índice. Ejecuta backend/ingest.py antes de /chat.")
 
-client = OpenAI(api_key=settings.openai_api_key)
+# Cliente asíncrono: no bloquea el event loop y reutiliza conexiones (keep-alive)
+client = AsyncOpenAI(api_key=settings.openai_api_key)
 
+# Prefijo estable (> 1024 tokens) al inicio de cada petición: activa la
+# caché automática de prompts de OpenAI. No interpolar nada variable aquí.
 SYSTEM_PROMPT = """
 Eres Isabel I de Castilla (Isabel la Católica). Hablas en primera persona, con tono cortesano y didáctico.
 Explica tus decisiones entre 1469 y 1504 con rigor histórico y lenguaje claro.
 Termina cada respuesta con una sección titulada 'Fuentes', listando los documentos relevantes.
+
+## Personaje
+- Eres la reina de Castilla, nacida en Madrigal de las Altas Torres en 1451 y fallecida en Medina del Campo en 1504.
+- Conoces tu vida y tu reinado hasta el día de tu muerte: el tratado de los Toros de Guisando (1468), tu matrimonio
+  con Fernando de Aragón (1469), la guerra de sucesión castellana (1475-1479), las Cortes de Toledo (1480),
+  la guerra de Granada (1482-1492), las Capitulaciones de Santa Fe, el primer viaje de Colón, el Tratado de
+  Tordesillas (1494), la política matrimonial de tus hijos y tu testamento y codicilo (1504).
+- No conoces nada posterior a noviembre de 1504. Si te preguntan por hechos posteriores, indícalo con cortesía
+  ("eso ocurrió después de mis días") y, si procede, explica lo que sabías o esperabas en vida.
+- Hablas como una soberana que instruye: con serenidad, autoridad y cercanía, nunca con arrogancia.
+
+## Uso del contexto recuperado
+- Recibirás fragmentos de documentos (crónicas, estudios, fuentes primarias y secundarias) en un mensaje aparte.
+- Basa tus afirmaciones en esos fragmentos siempre que sea posible. Si el contexto no cubre la pregunta,
+  dilo con claridad y responde solo con conocimiento histórico bien establecido, sin inventar citas ni datos.
+- Si los fragmentos se contradicen, menciónalo y explica qué interpretación te parece más sólida y por qué.
+- Nunca atribuyas a un documento algo que no dice. No inventes nombres de archivos, páginas ni fechas.
+- Distingue entre hechos documentados, interpretaciones de los historiadores y tu propia voz como personaje.
+
+## Rigor histórico
+- Cita fechas, lugares y personas con precisión. Si una fecha es aproximada o discutida, indícalo.
+- Evita anacronismos en los conceptos: habla de reinos, coronas, señoríos, concejos y Cortes, no de "Estado
+  nacional" ni de "España" como entidad política unificada, salvo para aclarar el uso moderno del término.
+- Trata los temas delicados (la Inquisición, la expulsión de los judíos en 1492, la conversión forzosa
+  de los mudéjares, el trato a los pueblos indígenas de las Indias) con seriedad: explica las razones que
+  se esgrimieron en tu tiempo y reconoce también sus consecuencias y la valoración crítica de la historiografía.
+- No justifiques la violencia ni la persecución; contextualízala históricamente sin trivializarla.
+- Cuando hables de Fernando, de tus hijos (Isabel, Juan, Juana, María y Catalina), de Cisneros, de Talavera,
+  de Gonzalo Fernández de Córdoba o de Colón, hazlo con el trato y la perspectiva que tendrías en vida.
+
+## Estilo
+- Responde en español, salvo que el usuario escriba en otro idioma; en ese caso responde en su idioma
+  manteniendo el mismo personaje y tono.
+- Usa un registro cortesano moderado: puedes emplear fórmulas como "os diré", "sabed que" o "en mi tiempo",
+  pero sin arcaísmos que dificulten la comprensión. La claridad pedagógica es prioritaria.
+- Estructura las respuestas largas en párrafos breves. Usa listas solo cuando ayuden a ordenar causas,
+  consecuencias o etapas.
+- Extensión orientativa: entre 150 y 400 palabras, salvo que la pregunta pida más detalle o una respuesta breve.
+- Termina, cuando tenga sentido, con una idea clave o una reflexión que ayude al estudiante a recordar lo esencial.
+- No uses emojis ni lenguaje coloquial actual. No rompas el personaje salvo para aclarar límites de las fuentes.
+
+## Público
+- Tu interlocutor suele ser un estudiante o un curioso de la historia. Explica los términos técnicos
+  (hermandad, corregidor, mayorazgo, bula, capitulación, patronato) la primera vez que aparezcan.
+- Si la pregunta parte de una premisa falsa o de un mito extendido, corrígelo con amabilidad y explica el origen del error.
+- Si la pregunta es ambigua, elige la interpretación más razonable, indícala y responde.
+- Si la pregunta no tiene relación con tu vida, tu época o tu reinado, reconduce la conversación con cortesía.
+
+## Sección 'Fuentes'
+- Al final de cada respuesta incluye una sección titulada 'Fuentes'.
+- Enumera solo los documentos del contexto recuperado que hayas usado, con el formato:
+  "- nombre_del_archivo, pág. N".
+- Si no has usado ningún fragmento, escribe "- Sin fuentes del corpus; respuesta basada en conocimiento histórico general."
+- No repitas la misma fuente varias veces; agrupa las páginas de un mismo documento cuando sea posible.
+
+## Instrucciones de respuesta
+Responde en tono pedagógico, en primera persona, como Isabel I de Castilla.
+Incluye una sección 'Fuentes' al final con las citas.
 """
 
+CONTEXT_HEADER = "Contexto recuperado a continuación (fragmentos con su archivo y página):"
+
+# Límite de k: las búsquedas se agrupan por lote (max(k)) y FAISS en GPU acota k
+MAX_K = 50
+
+# Longitud máxima de la consulta (caracteres); muy por debajo del límite del modelo de embeddings
+MAX_QUERY_CHARS = 4000
+
 class ChatRequest(BaseModel):
-    query: str
-    k: int = 5
+    query: str = Field(min_length=1, max_length=MAX_QUERY_CHARS)
+    k: int = Field(5, ge=1, le=MAX_K)
 
 class ChatResponse(BaseModel):
     answer: str
     sources: List[Dict[str, Any]]
 
-def retrieve(query: str, k: int = 5) -> List[Dict[str, Any]]:
-    if index is None or not meta:
-        return []
-    emb = client.embeddings.create(model=settings.embedding_model, input=[query]).data[0].embedding
+class MicroBatcher(ABC):
+    """
+    Agrupa peticiones concurrentes y las procesa juntas: la cola se vacía
+    cada `max_wait` segundos o en cuanto acumula `max_batch` elementos, y
+    cada lote se procesa en su propia tarea (como mucho `max_inflight` a la vez).
+    Las subclases implementan `_process(items) -> resultados` (mismo orden);
+    un resultado que sea una excepción solo falla la petición de ese elemento.
+    """
+
+    def __init__(self, max_wait: float, max_batch: int, max_inflight: int = 8):
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.max_inflight = max_inflight
+        self._queue: Optional[asyncio.Queue] = None
+        self._full: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, item: Any) -> Any:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._full = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_inflight)
+            self._worker = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, fut))
+        if self._queue.qsize() >= self.max_batch:
+            self._full.set()
+        return await fut
+
+    @abstractmethod
+    async def _process(self, items: List[Any]) -> List[Any]:
+        ...
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            # Cada lote se despacha en su propia tarea (hasta max_inflight a la vez):
+            # una llamada lenta no bloquea el vaciado de la cola
+            await self._slots.acquire()
+            task = asyncio.create_task(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        try:
+            results = await self._process([item for item, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        for (_, fut), res in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(res, BaseException):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+
+class SearchBatcher(MicroBatcher):
+    """
+    Un único index.search por lote (amortiza las copias host<->GPU); solo se
+    usa con el índice en GPU. Un lote a la vez: el índice GPU no admite
+    búsquedas concurrentes desde varios hilos sobre los mismos recursos.
+    """
+
+    def __init__(self, max_wait: float = 0.005, max_batch: int = 64):
+        super().__init__(max_wait, max_batch, max_inflight=1)
+
+    async def search(self, v: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return await self.submit((v, k))
+
+    async def _process(self, items: List[Tuple[np.ndarray, int]]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        vs = np.concatenate([v for v, _ in items])
+        k = max(k for _, k in items)
+        scores, idxs = await asyncio.to_thread(index.search, vs, k)
+        return [(scores[row:row + 1, :kk], idxs[row:row + 1, :kk]) for row, (_, kk) in enumerate(items)]
+
+class AsyncEmbeddingBatcher(MicroBatcher):
+    """Una única llamada a embeddings.create por lote de consultas."""
+
+    def __init__(self, max_wait: float = 0.010, max_batch: int = 32):
+        super().__init__(max_wait, max_batch)
+
+    async def embed(self, text: str) -> List[float]:
+        return await self.submit(text)
+
+    async def _create(self, items: List[str]) -> List[List[float]]:
+        resp = await client.embeddings.create(model=settings.embedding_model, input=items)
+        return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+    async def _process(self, items: List[str]) -> List[Any]:
+        try:
+            return await self._create(items)
+        except BadRequestError:
+            if len(items) == 1:
+                raise
+        # Un elemento inválido (400) no debe fallar el lote entero: se reintenta
+        # uno a uno. Otros errores (429, timeouts, red) se propagan sin multiplicar la carga.
+        results = await asyncio.gather(*(self._create([item]) for item in items), return_exceptions=True)
+        return [r if isinstance(r, BaseException) else r[0] for r in results]
+
+class SemanticCache:
+    """
+    Respuestas recientes indexadas por el embedding de su consulta.
+    Una consulta con similitud >= threshold (y el mismo k) reutiliza la
+    respuesta sin volver a buscar ni llamar al LLM. Al insertar se retiran
+    las entradas caducadas o equivalentes entre los vecinos; FIFO al llenarse.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_size: int = SEMANTIC_CACHE_SIZE, ttl: float = SEMANTIC_CACHE_TTL, probe: int = SEMANTIC_CACHE_PROBE):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.probe = probe
+        self._index: Optional[faiss.Index] = None
+        self._entries: List[Tuple[int, str, List[Dict[str, Any]], float]] = []  # (k, answer, sources, ts)
+
+    def _neighbours(self, v: np.ndarray) -> List[Tuple[int, float]]:
+        if self._index is None or self._index.ntotal == 0:
+            return []
+        D, I = self._index.search(v, min(self.probe, self._index.ntotal))
+        return [(int(i), float(d)) for d, i in zip(D[0], I[0]) if i != -1 and d >= self.threshold]
+
+    def _remove(self, ids: List[int]) -> None:
+        if not ids:
+            return
+        self._index.remove_ids(faiss.IDSelectorBatch(np.array(ids, dtype="int64")))
+        drop = set(ids)
+        self._entries = [e for n, e in enumerate(self._entries) if n not in drop]
+
+    def get(self, v: np.ndarray, k: int) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        for i, _ in self._neighbours(v):
+            ek, answer, sources, ts = self._entries[i]
+            if ek == k and now - ts <= self.ttl:
+                return {"answer": answer, "sources": sources}
+        return None
+
+    def put(self, v: np.ndarray, k: int, answer: str, sources: List[Dict[str, Any]]) -> None:
+        if self._index is None:
+            self._index = faiss.IndexFlatIP(v.shape[1])
+        now = time.time()
+        # La nueva entrada sustituye a las caducadas y a las equivalentes (mismo k)
+        self._remove([
+            i for i, _ in self._neighbours(v)
+            if self._entries[i][0] == k or now - self._entries[i][3] > self.ttl
+        ])
+        if self._index.ntotal >= self.max_size:
+            self._remove([0])
+        self._index.add(v)
+        self._entries.append((k, answer, sources, now))
+
+search_batcher = SearchBatcher()
+embedding_batcher = AsyncEmbeddingBatcher()
+semantic_cache = SemanticCache()
+embed_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+response_cache: TTLCache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+async def embed_query(query: str) -> np.ndarray:
+    v = embed_cache.get(query)
+    if v is not None:
+        embed_cache.move_to_end(query)
+        return v
+    emb = await embedding_batcher.embed(query)
     v = np.array([emb], dtype='float32')
     faiss.normalize_L2(v)
-    scores, idxs = index.search(v, min(k, len(meta)))
-    out = []
-    for score, i in zip(scores[0], idxs[0]):
-        if i == -1: continue
-        rec = meta[int(i)].copy()
-        rec["score"] = float(score)
-        out.append(rec)
-    return out
+    embed_cache[query] = v
+    if len(embed_cache) > EMBED_CACHE_SIZE:
+        embed_cache.popitem(last=False)
+    return v
+
+async def search_passages(v: np.ndarray, k: int = 5) -> List[Dict[str, Any]]:
+    if index is None or meta is None:
+        return []
+    kk = min(k, meta.num_rows)
+    if gpu_res is not None:
+        scores, idxs = await search_batcher.search(v, kk)
+    else:
+        # En CPU (p. ej. HNSW) agrupar no ahorra copias: búsqueda directa fuera del event loop
+        scores, idxs = await asyncio.to_thread(index.search, v, kk)
+    mask = idxs[0] != -1
+    rows = meta.take(pa.array(idxs[0][mask])).to_pylist()
+    for rec, score in zip(rows, scores[0][mask].tolist()):
+        rec["score"] = score
+    return rows
 
 def build_prompt(query: str, passages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
-    context_lines = [f"[{p['filename']} · pág. {p['page']}]\\n{p['text']}" for p in passages]
-    context = "\\n\\n".join(context_lines)
-    user_msg = (
-        f"Pregunta: {query}\\n\\n"
-        f"Contexto recuperado:\\n{context}\\n\\n"
-        "Responde en tono pedagógico, en primera persona, como Isabel I de Castilla. "
-        "Incluye una sección 'Fuentes' al final con las citas."
-    )
+    # Orden: prefijo estable -> contexto variable -> pregunta al final
+    context_lines = [f"[{p['filename']} · pág. {p['page']}]\n{p['text']}" for p in passages]
+    context = "\n\n".join(context_lines) or "(sin fragmentos recuperados)"
     return [
         {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": user_msg},
+        {"role": "system", "content": f"{CONTEXT_HEADER}\n\n{context}"},
+        {"role": "user", "content": f"Pregunta: {query}"},
     ]
 
 @app.get("/health")
@@ -89,9 +375,23 @@ async def health():
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat(req: ChatRequest):
-    passages = retrieve(req.query, k=req.k)
+    # El modelo forma parte de la clave: un cambio de configuración invalida la caché
+    key = (hashlib.sha1(req.query.encode("utf-8")).digest(), req.k, settings.model, settings.embedding_model)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached
+    if index is None or meta is None:
+        passages = []
+        v = None
+    else:
+        v = await embed_query(req.query)
+        cached = semantic_cache.get(v, req.k)
+        if cached is not None:
+            response_cache[key] = cached
+            return cached
+        passages = await search_passages(v, k=req.k)
     messages = build_prompt(req.query, passages)
-    completion = client.chat.completions.create(
+    completion = await client.chat.completions.create(
         model=settings.model,
         messages=messages,
         temperature=0.3,
@@ -102,4 +402,8 @@ async def chat(req: ChatRequest):
         {"filename": p.get("filename"), "page": p.get("page"), "text": (p.get("text") or "")[:500], "score": p.get("score", 0.0)}
         for p in passages
     ]
-    return {"answer": answer, "sources": sources}
+    if v is not None:
+        semantic_cache.put(v, req.k, answer, sources)
+    response = {"answer": answer, "sources": sources}
+    response_cache[key] = response
+    return response